@@ -1,15 +1,61 @@
 import abc
+import functools
 import re
 from dataclasses import dataclass
-from typing import Generic, Iterable, Optional, TypeVar
+from typing import Any, Callable, Generic, Iterable, Iterator, Optional, TypeVar
 
 import gym
 from rl.lm import Data
 
+ASSERT_REWARD_PATTERN = re.compile(r"assert reward == \d+")
+REWARD_PATTERN = re.compile(r"reward == (\d+)")
+REWARD_PREFIX = "reward == "
+
 ObsType = TypeVar("ObsType")
 ActType = TypeVar("ActType")
 
 
+class SharedCache(dict):
+    # env caches only depend on settings fixed at construction, so copies of an env
+    # (e.g. the deepcopy in Q.rollout) share them instead of copying them
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def memoize(method: Callable[[Any, Any], str]) -> Callable[[Any, Any], str]:
+    # per-env cache, shared with copies, for string renderers of a single argument
+    name = f"_{method.__name__}_cache"
+
+    @functools.wraps(method)
+    def wrapper(self, arg):
+        cache = self.__dict__.get(name)
+        if cache is None:
+            cache = self.__dict__[name] = SharedCache()
+        try:
+            return cache[arg]
+        except KeyError:
+            string = cache[arg] = method(self, arg)
+            return string
+        except TypeError:  # unhashable argument
+            return method(self, arg)
+
+    return wrapper
+
+
+def reward_digits(prompt: str) -> Iterator[int]:
+    # same matches as re.findall(r"reward == (\d)", prompt), scanned with str.find
+    start = prompt.find(REWARD_PREFIX)
+    while start >= 0:
+        i = start + len(REWARD_PREFIX)
+        if i < len(prompt) and prompt[i].isdecimal():
+            yield int(prompt[i])
+            i += 1
+        start = prompt.find(REWARD_PREFIX, i)
+
+
 @dataclass
 class TimeStep(Generic[ObsType, ActType]):
     state: ObsType
@@ -25,16 +71,18 @@ class Env(gym.Env, Generic[ObsType, ActType], abc.ABC):
     hint: bool
 
     def action(self, action_str: Optional[str]) -> Optional[ActType]:
-        action_space = self.action_space
-        assert isinstance(action_space, gym.spaces.Discrete)
-        try:
-            actions = [
-                a for a in range(action_space.n) if self.action_str(a) == action_str
-            ]
-            [action] = actions
-            return action
-        except ValueError:
-            return None
+        action_index = getattr(self, "_action_index", None)
+        if action_index is None:
+            action_space = self.action_space
+            assert isinstance(action_space, gym.spaces.Discrete)
+            # action strings are fixed per env, so index them on first use;
+            # strings shared by several actions are ambiguous and map to None
+            action_index = SharedCache()
+            for a in range(action_space.n):
+                s = self.action_str(a)
+                action_index[s] = None if s in action_index else a
+            self._action_index = action_index
+        return action_index.get(action_str)
 
     @staticmethod
     def action_stop() -> str:
@@ -80,7 +128,7 @@ class Env(gym.Env, Generic[ObsType, ActType], abc.ABC):
 
     @staticmethod
     def reward(reward_str: str) -> float:
-        matches = re.findall(r"reward == (\d+)", reward_str)
+        matches = REWARD_PATTERN.findall(reward_str)
         try:
             [reward] = matches
         except ValueError:
@@ -3,8 +3,8 @@ Classic cart-pole system implemented by Rich Sutton et al.
 Copied from https://incompleteideas.net/sutton/book/code/pole.c
 permalink: https://perma.cc/C9ZM-652R
 """
+import itertools
 import math
-import re
 from typing import Iterable, NamedTuple, Optional, SupportsFloat, Tuple
 
 import base_env
@@ -442,7 +442,7 @@ class Wrapper(gym.Wrapper, base_env.Env[Obs, int]):
 
     def valid_reward(self, reward_str: str) -> bool:
         return bool(
-            re.findall(r"assert reward == \d+", reward_str)
+            base_env.ASSERT_REWARD_PATTERN.search(reward_str)
         ) and reward_str.endswith(self.reward_stop())
 
     def valid_state(self, state_str: str) -> bool:
@@ -460,8 +460,7 @@ class Wrapper(gym.Wrapper, base_env.Env[Obs, int]):
     def quantify(self, prompt: str, gamma: Optional[float] = None) -> float:
         if gamma is None:
             gamma = self.gamma()
-        matches = re.findall(r"reward == (\d)", prompt)
-        matches = matches[: self.max_q_steps()]
+        matches = itertools.islice(base_env.reward_digits(prompt), self.max_q_steps())
         return sum([gamma**t * float(x) for t, x in enumerate(matches)])
 
     def reset(self, **kwargs):
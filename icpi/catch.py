@@ -14,7 +14,6 @@
 # limitations under the License.
 # ============================================================================
 """Catch reinforcement learning environment."""
-import re
 from typing import List, NamedTuple, Optional, Tuple, cast
 
 import base_env
@@ -122,6 +121,24 @@ class Env(base.Environment):
     def _observation(self) -> Obs:
         return Obs(paddle_x=self._paddle_x, ball_x=self._ball_x, ball_y=self._ball_y)
 
+    def restore(self, snapshot: tuple):
+        (
+            self._ball_x,
+            self._ball_y,
+            self._paddle_x,
+            self._paddle_y,
+            self._reset_next_step,
+        ) = snapshot
+
+    def snapshot(self) -> tuple:
+        return (
+            self._ball_x,
+            self._ball_y,
+            self._paddle_x,
+            self._paddle_y,
+            self._reset_next_step,
+        )
+
     def bsuite_info(self):
         return dict(optimal=1)
 
@@ -142,6 +159,7 @@ class Wrapper(gym.Wrapper, base_env.Env[Obs, int]):
     def action_stop(self) -> str:
         return "\nball.descend()\n"
 
+    @base_env.memoize
     def action_str(self, action: int) -> str:
         return f"reward = paddle.{self.actions()[action]}(){self.action_stop()}"
 
@@ -195,6 +213,10 @@ class Wrapper(gym.Wrapper, base_env.Env[Obs, int]):
         assert isinstance(self.env, Env)
         return self.env.reset().observation
 
+    def restore(self, snapshot: tuple):
+        assert isinstance(self.env, Env)
+        self.env.restore(snapshot)
+
     @staticmethod
     def reward_stop() -> str:
         return "\n"
@@ -205,12 +227,17 @@ class Wrapper(gym.Wrapper, base_env.Env[Obs, int]):
     def seed(self, seed: Optional[int] = None):
         self._rng = np.random.RandomState(seed)
 
+    def snapshot(self) -> tuple:
+        assert isinstance(self.env, Env)
+        return self.env.snapshot()
+
     def start_states(self) -> Optional[List[Obs]]:
         return [
             Obs(self.env.columns // 2, ball_x, self.env.rows - 1)
             for ball_x in range(self.env.columns)
         ]
 
+    @base_env.memoize
     def state_str(self, state: Obs) -> str:
         state_str = f"assert paddle == C({state.paddle_x}, 0) and ball == C({state.ball_x}, {state.ball_y})"
         if self.hint:
@@ -279,7 +306,7 @@ class Wrapper(gym.Wrapper, base_env.Env[Obs, int]):
 
     def valid_reward(self, reward_str: str) -> bool:
         return bool(
-            re.findall(r"assert reward == [0-9]+", reward_str)
+            base_env.ASSERT_REWARD_PATTERN.search(reward_str)
         ) and reward_str.endswith(self.reward_stop())
 
     def valid_state(self, state_str: str) -> bool:
@@ -222,9 +222,10 @@ def collect_trajectory(
         action = env.action_space.sample()
         good_actions = []
         if not hopeless(state):
+            snapshot = env.snapshot()
             for a in range(len(ACTIONS)):
-                _env = deepcopy(env)
-                s, _, _, _ = _env.step(a)
+                s, _, _, _ = env.step(a)
+                env.restore(snapshot)
                 if not hopeless(s):
                     good_actions.append(a)
 
@@ -1,4 +1,3 @@
-import re
 from dataclasses import dataclass
 from typing import Iterable, Optional, Tuple
 
@@ -28,6 +27,7 @@ class Env(base_env.Env[int, int]):
             len(self.actions()), seed=self.random_seed
         )
 
+    @base_env.memoize
     def action_str(self, action: int) -> str:
         action_str = self.actions()[action]
         if action == 1:
@@ -81,6 +81,7 @@ class Env(base_env.Env[int, int]):
     def start_states(self) -> Optional[Iterable[int]]:
         return None
 
+    @base_env.memoize
     def state_str(self, state: Tuple[int, ...]) -> str:
         state_str = f"assert state == {list(state)}"
         if self.hint:
@@ -127,7 +128,7 @@ class Env(base_env.Env[int, int]):
 
     def valid_reward(self, reward_str: str) -> bool:
         return bool(
-            re.findall(r"assert reward == \d+", reward_str)
+            base_env.ASSERT_REWARD_PATTERN.search(reward_str)
         ) and reward_str.endswith(self.reward_stop())
 
     def valid_state(self, state_str: str) -> bool:
@@ -1,4 +1,3 @@
-import re
 from dataclasses import astuple, dataclass, field
 from typing import Generic, Iterable, Iterator, NamedTuple, Optional, Tuple, TypeVar
 
@@ -141,6 +140,7 @@ class Env(base_env.Env[C, int]):
     def action_stop() -> str:
         return "\n"
 
+    @base_env.memoize
     def action_str(self, action: int) -> str:
         action_str = self.actions()[action]
         return f"state, reward = {action_str}(){self.action_stop()}"
@@ -206,6 +206,7 @@ class Env(base_env.Env[C, int]):
                 if coord != self.goal:
                     yield coord
 
+    @base_env.memoize
     def state_str(self, state: C) -> str:
         state_str = f"assert state == {state}"
         if self.hint:
@@ -257,7 +258,7 @@ class Env(base_env.Env[C, int]):
 
     def valid_reward(self, reward_str: str) -> bool:
         return bool(
-            re.findall(r"assert reward == \d+", reward_str)
+            base_env.ASSERT_REWARD_PATTERN.search(reward_str)
         ) and reward_str.endswith(self.reward_stop())
 
     def valid_state(self, state_str: str) -> bool:
@@ -1,4 +1,5 @@
 import abc
+import functools
 import itertools
 import re
 from dataclasses import dataclass
@@ -11,32 +12,34 @@ from rl.api.local import API
 
 
 def _get_prob(target: str, logprobs: List[Dict[str, float]]) -> Tuple[float, str]:
-    if not target or not logprobs:
-        return 1, target
-
-    def get_prob_rec(logprobs):
-        while logprobs:
-            head, *logprobs = logprobs
-            for token, lp in head.items():
-                prob = np.exp(lp)
-                if target.startswith(token):
-                    prob_rest, leftover = _get_prob(target[len(token) :], logprobs)
-                    yield prob * prob_rest, leftover
-            # logprobs = [
-            #     {k: v for k, v in lp.items() if k not in head} for lp in logprobs
-            # ]
-
-    rec = list(get_prob_rec(logprobs))
-    if not rec:
-        return 0, target
-    if all([leftover for prob, leftover in rec]):
-        smallest_leftover = min([leftover for prob, leftover in rec], key=len)
-        probs = [
-            (prob, leftover) for prob, leftover in rec if leftover == smallest_leftover
+    # results only depend on how much of target and logprobs remain, so index into
+    # both instead of copying them at each level of the search
+    @functools.lru_cache(maxsize=None)
+    def get_prob_from(offset: int, start: int) -> Tuple[float, str]:
+        if offset == len(target) or start == len(logprobs):
+            return 1, target[offset:]
+
+        rec = [
+            (np.exp(lp) * prob_rest, leftover)
+            for i in range(start, len(logprobs))
+            for token, lp in logprobs[i].items()
+            if target.startswith(token, offset)
+            for prob_rest, leftover in [get_prob_from(offset + len(token), i + 1)]
         ]
-    else:
-        probs = [(prob, leftover) for prob, leftover in rec if not leftover]
-    return max(probs)
+        if not rec:
+            return 0, target[offset:]
+        if all([leftover for prob, leftover in rec]):
+            smallest_leftover = min([leftover for prob, leftover in rec], key=len)
+            probs = [
+                (prob, leftover)
+                for prob, leftover in rec
+                if leftover == smallest_leftover
+            ]
+        else:
+            probs = [(prob, leftover) for prob, leftover in rec if not leftover]
+        return max(probs)
+
+    return get_prob_from(0, 0)
 
 
 def get_prob(target: str, logprobs: List[Dict[str, float]]) -> float:
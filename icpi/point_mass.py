@@ -1,5 +1,5 @@
+import itertools
 import math
-import re
 from dataclasses import dataclass, field
 from typing import Iterable, NamedTuple, Optional
 
@@ -85,8 +85,7 @@ class Env(base_env.Env):
     def quantify(self, prompt: str, gamma: Optional[float] = None) -> float:
         if gamma is None:
             gamma = self.gamma()
-        matches = re.findall(r"reward == (\d)", prompt)
-        matches = matches[: self.max_q_steps()]
+        matches = itertools.islice(base_env.reward_digits(prompt), self.max_q_steps())
         return sum([gamma**t * float(x) for t, x in enumerate(matches)])
 
     def reset(self):
@@ -170,7 +169,7 @@ class Env(base_env.Env):
 
     def valid_reward(self, reward_str: str) -> bool:
         return bool(
-            re.findall(r"assert reward == \d+", reward_str)
+            base_env.ASSERT_REWARD_PATTERN.search(reward_str)
         ) and reward_str.endswith(self.reward_stop())
 
     def valid_state(self, state_str: str) -> bool:
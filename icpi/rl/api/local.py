@@ -1,7 +1,7 @@
 import re
 import sys
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import requests
 from rl.common import Colorize, Debug
@@ -19,8 +19,12 @@ class Local(LM):
     query_count: int = 0
     query_tick: float = time.time()
     query_times: float = 0
+    session: requests.Session = field(init=False)
 
     def __post_init__(self):
+        super().__post_init__()
+        # reuse one keep-alive connection instead of reconnecting for every query
+        self.session = requests.Session()
         self.tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
         self.start_time = time.time()
         self.max_tokens_accepted_by_lm = 600
@@ -66,7 +70,7 @@ class Local(LM):
             sys.stdout.flush()
             self.query_tick = time.time()
             self.query_count += 1
-            response = requests.post(
+            response = self.session.post(
                 self.url,
                 headers={
                     "accept": "application/json",
@@ -1,10 +1,13 @@
 import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, List, Optional
 
 import openai
+from rl.api.rate_limit import RateLimiter
 from rl.common import Colorize, Debug
 from rl.lm import LM, Data
 from transformers import GPT2TokenizerFast
@@ -18,11 +21,14 @@ class OpenAi(LM):
     completion_count: int = 0
     completion_times: float = 0
     error_count: int = 0
+    max_concurrency: int = 4
+    prompts_per_request: int = 20
     query_count: int = 0
-    query_tick: float = time.time()
     query_times: float = 0
+    tokens_per_minute: Optional[float] = None
 
     def __post_init__(self):
+        super().__post_init__()
         self.tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
         self.start_time = time.time()
         self.max_tokens_accepted_by_lm = {
@@ -30,69 +36,158 @@ class OpenAi(LM):
             "code-cushman-001": 2049,
         }[self.model_name]
         assert self.logprobs <= 5
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.lock = threading.Lock()
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=60 / self.wait_time if self.wait_time else None,
+            tokens_per_minute=self.tokens_per_minute,
+        )
 
     def get_full_completion(
         self, prompt: str, stop: list[str], temperature: float, use_cache: bool = True
     ):
+        [completion] = self.get_full_completions(
+            [prompt], stop=stop, temperature=temperature, use_cache=use_cache
+        )
+        return completion
+
+    def get_full_completions(
+        self,
+        prompts: List[str],
+        stop: list[str],
+        temperature: float,
+        use_cache: bool = True,
+    ) -> List[dict]:
         if Debug.print_api_call_indicator.meets_threshold(self.debug):
             print("<", end="")
 
-        prompt = self.clip_prompt(prompt)
+        prompts = [self.clip_prompt(prompt) for prompt in prompts]
+        completions: List[Optional[dict]] = [None for _ in prompts]
 
         if use_cache:
-            completions = self.get_completions(
-                prompt, stop=stop, temperature=temperature
+            for i, prompt in enumerate(prompts):
+                cached = self.get_completions(
+                    prompt, stop=stop, temperature=temperature
+                )
+                if cached:
+                    completions[i], *_ = cached
+                elif self.require_cache:
+                    print(prompt)
+                    Colorize.print_warning(
+                        "No completions found in cache for this prompt."
+                    )
+                    exit()
+
+        # only prompts that missed the cache are sent, each once, in a single request
+        misses: Dict[str, List[int]] = {}
+        for i, completion in enumerate(completions):
+            if completion is None:
+                misses.setdefault(prompts[i], []).append(i)
+        if misses:
+            new_completions = self.create_completions(
+                list(misses), stop=stop, temperature=temperature
             )
-            if completions:
-                completion, *_ = completions
-                # print("Completion:")
-                # print(value)
-                if Debug.print_api_call_indicator.meets_threshold(self.debug):
-                    print(">", end="")
-                return completion
-            elif self.require_cache:
-                print(prompt)
-                Colorize.print_warning("No completions found in cache for this prompt.")
-                exit()
+            for indices, completion in zip(misses.values(), new_completions):
+                for i in indices:
+                    completions[i] = completion
+
+        if Debug.print_api_call_indicator.meets_threshold(self.debug):
+            print(">", end="")
+        return completions
 
+    def create_completions(
+        self, prompts: List[str], stop: list[str], temperature: float
+    ) -> List[dict]:
         if Debug.debug_api_calls.meets_threshold(self.debug):
-            print("Prompt:")
-            print(prompt)
+            print("Prompts:")
+            for prompt in prompts:
+                print(prompt)
             breakpoint()
         completion_tick = time.time()
-        self.completion_count += 1
+        self.completion_count += len(prompts)
+
+        # count tokens here since the tokenizer is not shared across threads, and only
+        # when they are rate limited
+        futures = []
+        for i in range(0, len(prompts), self.prompts_per_request):
+            chunk = prompts[i : i + self.prompts_per_request]
+            num_tokens = 0
+            if self.rate_limiter.tokens_per_minute is not None:
+                num_tokens = sum(
+                    len(self.tokenize(prompt)) + self.max_tokens_in_completion
+                    for prompt in chunk
+                )
+            futures.append(
+                self.executor.submit(self.get_choices, chunk, stop, num_tokens)
+            )
+        choices = [choice for future in futures for choice in future.result()]
+
+        if self.logger.run_id is not None:
+            self.logger.log(
+                **{
+                    "hours": (time.time() - self.start_time) / 3600,
+                    "run ID": self.logger.run_id,
+                    "seconds per query": self.query_times / self.query_count,
+                    "API error probability": self.error_count / self.query_count,
+                },
+            )
+
+        completions = []
+        for prompt, choice in zip(prompts, choices):
+            top_logprobs = [l.to_dict() for l in choice.logprobs.top_logprobs]
+            completion = choice.text.lstrip()
+            response = self.post_completion(
+                completion=completion,
+                prompt=prompt,
+                stop=stop,
+                temperature=temperature,
+                top_logprobs=top_logprobs,
+            )["insert_completions_one"]["completion"]
+            if response != completion:
+                breakpoint()
+            if Debug.debug_api_calls.meets_threshold(self.debug):
+                print("Completion:", completion.split("\n")[0])
+                breakpoint()
+            completions.append(
+                dict(
+                    prompt=prompt,
+                    completion=completion,
+                    top_logprobs=top_logprobs,
+                )
+            )
+        self.completion_times += time.time() - completion_tick
+        if self.logger.run_id is not None:
+            self.logger.log(
+                **{
+                    "hours": (time.time() - self.start_time) / 3600,
+                    "run ID": self.logger.run_id,
+                    "seconds per completion": self.completion_times
+                    / self.completion_count,
+                },
+            )
+        return completions
+
+    def get_choices(self, prompts: List[str], stop: list[str], num_tokens: int):
         while True:
             # print("Prompt:", prompt.split("\n")[-1])
             sys.stdout.flush()
             try:
-                time_since_last_query = time.time() - self.query_tick
-                time.sleep(max(0.0, self.wait_time - time_since_last_query))
-                self.query_tick = time.time()
-                self.query_count += 1
-                choice, *_ = openai.Completion.create(
+                self.rate_limiter.acquire(num_tokens)
+                query_tick = time.time()
+                with self.lock:
+                    self.query_count += 1
+                choices = openai.Completion.create(
                     engine=self.model_name,
                     max_tokens=self.max_tokens_in_completion,
-                    prompt=prompt,
+                    prompt=prompts,
                     logprobs=self.logprobs,
                     temperature=0.1,
                     stop=stop,
                 ).choices
-                self.query_times += time.time() - self.query_tick
-
-                if self.logger.run_id is not None:
-                    self.logger.log(
-                        **{
-                            "hours": (time.time() - self.start_time) / 3600,
-                            "run ID": self.logger.run_id,
-                            "seconds per query": self.query_times / self.query_count,
-                            "API error probability": self.error_count
-                            / self.query_count,
-                        },
-                    )
-                # if not choice.text:
-                #     print(prompt)
-                #     Colorize.print_warning("Empty completion!")
-                #     breakpoint()
+                with self.lock:
+                    self.query_times += time.time() - query_tick
+                # choices are indexed by the position of their prompt in the request
+                return sorted(choices, key=lambda c: c.index)
             except (
                 openai.error.RateLimitError,
                 openai.error.ServiceUnavailableError,
@@ -106,7 +201,8 @@ class OpenAi(LM):
                     print(type(e))
                     print(e)
                 sys.stdout.flush()
-                self.error_count += 1
+                with self.lock:
+                    self.error_count += 1
                 continue
             except openai.error.InvalidRequestError as e:
                 print("Invalid request error:")
@@ -114,38 +210,6 @@ class OpenAi(LM):
                 self.max_tokens_accepted_by_lm -= 100
                 continue
 
-            top_logprobs = [l.to_dict() for l in choice.logprobs.top_logprobs]
-            completion = choice.text.lstrip()
-            response = self.post_completion(
-                completion=completion,
-                prompt=prompt,
-                stop=stop,
-                temperature=temperature,
-                top_logprobs=top_logprobs,
-            )["insert_completions_one"]["completion"]
-            if response != completion:
-                breakpoint()
-            if Debug.print_api_call_indicator.meets_threshold(self.debug):
-                print(">", end="")
-            if Debug.debug_api_calls.meets_threshold(self.debug):
-                print("Completion:", completion.split("\n")[0])
-                breakpoint()
-            self.completion_times += time.time() - completion_tick
-            if self.logger.run_id is not None:
-                self.logger.log(
-                    **{
-                        "hours": (time.time() - self.start_time) / 3600,
-                        "run ID": self.logger.run_id,
-                        "seconds per completion": self.completion_times
-                        / self.completion_count,
-                    },
-                )
-            return dict(
-                prompt=prompt,
-                completion=completion,
-                top_logprobs=top_logprobs,
-            )
-
     def max_prompt_tokens(self) -> int:
         return self.max_tokens_accepted_by_lm - self.max_tokens_in_completion - 100
 
@@ -0,0 +1,73 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class RateLimiter:
+    requests_per_minute: Optional[float]
+    tokens_per_minute: Optional[float]
+    available_requests: float = field(init=False)
+    available_tokens: float = field(init=False)
+    last_update: float = field(init=False)
+    lock: threading.Lock = field(init=False)
+
+    def __post_init__(self):
+        # the request bucket holds a single request and starts empty, so requests are
+        # spaced at least 60 / requests_per_minute seconds apart, including the first
+        self.available_requests = 0
+        self.available_tokens = self.tokens_per_minute or 0
+        self.last_update = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        while True:
+            with self.lock:
+                self.refill()
+                wait_time = max(
+                    self.wait_time(
+                        self.available_requests, 1, 1, self.requests_per_minute
+                    ),
+                    self.wait_time(
+                        self.available_tokens,
+                        tokens,
+                        self.tokens_per_minute,
+                        self.tokens_per_minute,
+                    ),
+                )
+                if wait_time == 0:
+                    if self.requests_per_minute is not None:
+                        self.available_requests -= 1
+                    if self.tokens_per_minute is not None:
+                        self.available_tokens -= min(tokens, self.tokens_per_minute)
+                    return
+            time.sleep(wait_time)
+
+    def refill(self):
+        now = time.time()
+        minutes = (now - self.last_update) / 60
+        self.last_update = now
+        if self.requests_per_minute is not None:
+            self.available_requests = min(
+                1, self.available_requests + minutes * self.requests_per_minute
+            )
+        if self.tokens_per_minute is not None:
+            self.available_tokens = min(
+                self.tokens_per_minute,
+                self.available_tokens + minutes * self.tokens_per_minute,
+            )
+
+    @staticmethod
+    def wait_time(
+        available: float,
+        required: float,
+        capacity: Optional[float],
+        per_minute: Optional[float],
+    ):
+        if per_minute is None:
+            return 0.0
+        assert capacity is not None
+        # requests larger than the whole bucket only wait for it to fill
+        missing = min(required, capacity) - available
+        return max(0.0, 60 * missing / per_minute)
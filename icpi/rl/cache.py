@@ -0,0 +1,74 @@
+import hashlib
+import json
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+
+@dataclass
+class CompletionCache:
+    path: Path
+    max_entries: Optional[int] = None
+    connection: sqlite3.Connection = field(init=False)
+    size: int = field(init=False)
+
+    def __post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            str(self.path), isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(hash BLOB PRIMARY KEY, completion TEXT NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)"
+        )
+        self.size = self.count()
+
+    def count(self) -> int:
+        [size] = self.connection.execute("SELECT COUNT(*) FROM completions").fetchone()
+        return size
+
+    def evict(self):
+        # the cache is shared across runs, so recount before dropping the oldest tenth
+        assert self.max_entries is not None
+        self.size = self.count()
+        excess = self.size - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM completions WHERE hash IN "
+                "(SELECT hash FROM completions ORDER BY accessed LIMIT ?)",
+                (excess + self.max_entries // 10,),
+            )
+            self.size = self.count()
+
+    def get(self, key: str) -> Optional[dict]:
+        digest = self.hash(key)
+        row = self.connection.execute(
+            "SELECT completion FROM completions WHERE hash = ?", (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE completions SET accessed = ? WHERE hash = ?", (time.time(), digest)
+        )
+        [completion] = row
+        return json.loads(completion)
+
+    @staticmethod
+    def hash(key: str) -> bytes:
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def put(self, key: str, completion: dict):
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO completions VALUES (?, ?, ?)",
+            (self.hash(key), json.dumps(completion), time.time()),
+        )
+        self.size += cursor.rowcount
+        if self.max_entries is not None and self.size > self.max_entries:
+            self.evict()
@@ -1,14 +1,32 @@
+import functools
+import json
+import os
 import re
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import List
+from pathlib import Path
+from typing import List, Tuple
 
+from rl.cache import CompletionCache
 from run_logger import RunLogger
 from transformers import PreTrainedTokenizer
 
 from gql import gql
 
+# shared by every run on the machine so that restarts start with a warm cache
+CACHE_PATH = Path(
+    os.getenv(
+        "COMPLETION_CACHE", Path.home() / ".cache" / "icpi" / "completions.sqlite"
+    )
+)
+MAX_CACHE_ENTRIES = 1_000_000
+
+
+@functools.lru_cache(maxsize=1024)
+def _tokenize(tokenizer: PreTrainedTokenizer, prompt: str) -> Tuple[int, ...]:
+    return tuple(tokenizer(prompt)["input_ids"])
+
 
 class Data(Enum):
     code = auto()
@@ -24,8 +42,12 @@ class LM(ABC):
     top_p: float
     max_tokens_in_completion: int
     require_cache: bool
+    cache: CompletionCache = field(init=False)
     tokenizer: PreTrainedTokenizer = field(init=False)
 
+    def __post_init__(self):
+        self.cache = CompletionCache(CACHE_PATH, max_entries=MAX_CACHE_ENTRIES)
+
     def __call__(
         self, prompt: str, stop: List[str], temperature: float, use_cache: bool = True
     ):
@@ -33,14 +55,57 @@ class LM(ABC):
             prompt, stop=stop, temperature=temperature, use_cache=use_cache
         )["completion"]
 
+    def complete_all(
+        self,
+        prompts: List[str],
+        stop: List[str],
+        temperature: float,
+        use_cache: bool = True,
+    ) -> List[str]:
+        completions = self.get_full_completions(
+            prompts, stop=stop, temperature=temperature, use_cache=use_cache
+        )
+        return [completion["completion"] for completion in completions]
+
     @abstractmethod
     def get_full_completion(
         self, prompt: str, stop: list[str], temperature: float, use_cache: bool = True
     ):
         ...
 
+    def get_full_completions(
+        self,
+        prompts: List[str],
+        stop: list[str],
+        temperature: float,
+        use_cache: bool = True,
+    ) -> List[dict]:
+        return [
+            self.get_full_completion(
+                prompt, stop=stop, temperature=temperature, use_cache=use_cache
+            )
+            for prompt in prompts
+        ]
+
+    def cache_key(self, prompt: str, stop: List[str], temperature: float) -> str:
+        return json.dumps(
+            dict(
+                logprobs=self.logprobs,
+                model=self.model_name,
+                prompt=prompt,
+                stop=stop,
+                temperature=float(temperature),
+                top_p=float(self.top_p),
+            ),
+            sort_keys=True,
+        )
+
     def get_completions(self, prompt: str, stop: List[str], temperature: float):
-        return self.logger.execute(
+        key = self.cache_key(prompt, stop=stop, temperature=temperature)
+        completion = self.cache.get(key)
+        if completion is not None:
+            return [completion]
+        completions = self.logger.execute(
             gql(
                 """
 query get_completion($prompt: String!, $temperature: numeric!, $top_p: numeric!, $best_of: Int, $stop: jsonb, $logprobs: Int!, $model: String!) {
@@ -60,11 +125,14 @@ query get_completion($prompt: String!, $temperature: numeric!, $top_p: numeric!,
                 top_p=self.top_p,
             ),
         )["completions"]
+        if completions:
+            completion, *_ = completions
+            self.cache.put(key, completion)
+        return completions
 
     def clip_prompt(self, prompt: str) -> str:
-        tokens = self.tokenizer(prompt)["input_ids"]
-        tokens = tokens[-self.max_prompt_tokens() :]
-        new_prompt = self.tokenizer.decode(tokens, skip_special_tokens=True)
+        tokens = self.tokenize(prompt)[-self.max_prompt_tokens() :]
+        new_prompt = self.tokenizer.decode(list(tokens), skip_special_tokens=True)
         new_prompt = re.sub(r"(\S)!=", r"\1 !=", new_prompt)
         l = list(zip(reversed(prompt), reversed(new_prompt)))
         for i, (old, new) in enumerate(reversed(l)):
@@ -87,6 +155,10 @@ query get_completion($prompt: String!, $temperature: numeric!, $top_p: numeric!,
         temperature: float,
         top_logprobs: list,
     ):
+        self.cache.put(
+            self.cache_key(prompt, stop=stop, temperature=temperature),
+            dict(prompt=prompt, completion=completion, top_logprobs=top_logprobs),
+        )
         return self.logger.execute(
             query=gql(
                 """
@@ -110,6 +182,10 @@ query get_completion($prompt: String!, $temperature: numeric!, $top_p: numeric!,
             ),
         )
 
+    def tokenize(self, prompt: str) -> Tuple[int, ...]:
+        # identical prompts, e.g. from repeated rollouts, skip the BPE pass
+        return _tokenize(self.tokenizer, prompt)
+
     @abstractmethod
     def trained_on(self) -> Data:
         ...
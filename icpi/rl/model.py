@@ -1,34 +1,52 @@
 import abc
-import itertools
 from collections import defaultdict
 from copy import deepcopy
-from dataclasses import dataclass
-from typing import Any, Callable, Deque, Generic, List, Optional, Tuple
-
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
 from base_env import ActType, Env, ObsType, TimeStep
 from gym.spaces import Discrete
-from numpy.random import Generator
 from rich.syntax import Syntax
-from rl.common import Colorize, Debug, console, get_value
+from rl.common import Colorize, Debug, console
 from rl.lm import LM
 
+# (prompt, stop) pairs yielded by routines that query the LM
+Query = Tuple[str, str]
+Routine = Generator[Query, str, Any]
+
 
 @dataclass
 class Model(abc.ABC, Generic[ObsType, ActType]):
     break_on_invalid: bool
     buffer: Deque[List[TimeStep]]
+    buffer_values: Deque[float]
     env: Env
     debug: int
     lm: LM
     max_prompts: int
     max_resamples: int
     policy_env: Env
-    rng: Generator
+    rng: np.random.Generator
     sil: bool
     success_buffer: Deque[List[TimeStep]]
     temperature: float
     t_threshold: Optional[int]
     use_cache: bool
+    rendered_successes: Dict[
+        int, Tuple[List[TimeStep], List[str], List[Tuple[int, int]]]
+    ] = field(default_factory=dict, init=False)
 
     def act(self, state: ObsType, T: int) -> ActType:
         if self.ready():
@@ -46,16 +64,14 @@ class Model(abc.ABC, Generic[ObsType, ActType]):
             breakpoint()
 
     def extend(self, lst: List, length: int) -> List:
-        lst = list(lst)
-        self.rng.shuffle(lst)
-        lst = list(itertools.islice(itertools.cycle(lst), length))
+        # only the partial copy at the end needs sampling; the final shuffle orders all
+        copies, remainder = divmod(length, len(lst))
+        indices = self.rng.choice(len(lst), size=remainder, replace=False)
+        lst = list(lst) * copies + [lst[i] for i in indices]
         self.rng.shuffle(lst)
         assert len(lst) == length
         return lst
 
-    def get_value(self, trajectory: List[TimeStep]) -> float:
-        return get_value(*trajectory, gamma=self.env.gamma())
-
     def predict(
         self,
         query,
@@ -65,7 +81,7 @@ class Model(abc.ABC, Generic[ObsType, ActType]):
         stop: str,
         T: int,
         valid: Callable[[str], bool],
-    ) -> Optional[Any]:
+    ) -> Generator[Query, str, Optional[Any]]:
         if self.lm is None:
             for t in reversed(self.buffer):
                 for ts in reversed(t):
@@ -80,34 +96,31 @@ class Model(abc.ABC, Generic[ObsType, ActType]):
                             )[name]
             return None
 
+        query_str = "".join(query)
         previous_prompts = set()
         for _ in range(self.max_resamples):
-            prompts = get_prompts()
+            prompts_str = "".join(get_prompts())
+            # redraw up to max_prompts times to avoid repeating an earlier prompt
             for _ in range(self.max_prompts):
-                prompts = get_prompts()
-                if "".join(prompts) not in previous_prompts:
+                if prompts_str not in previous_prompts:
                     break
-            previous_prompts.add("".join(prompts))
+                prompts_str = "".join(get_prompts())
+            previous_prompts.add(prompts_str)
 
-            new_prompt = "".join([*prompts, "".join(query)])
+            new_prompt = prompts_str + query_str
             if self.debug in [
                 Debug.debug_inferences,
                 Debug.debug_rollouts_and_print_inferences,
             ]:
                 print()
                 console.print(
-                    Syntax("".join(prompts).rstrip("\n"), "python", theme="ansi_dark"),
+                    Syntax(prompts_str.rstrip("\n"), "python", theme="ansi_dark"),
                     end="",
                 )
                 console.rule(characters="·")
-                console.print(Syntax("".join(query), "python", theme="ansi_light"))
+                console.print(Syntax(query_str, "python", theme="ansi_light"))
             self.breakpoint(T, Debug.debug_inferences)
-            completion = self.lm(
-                new_prompt,
-                stop=[stop],
-                temperature=self.temperature,
-                use_cache=self.use_cache,
-            )
+            completion = yield new_prompt, stop
             if "state!=" in completion:
                 breakpoint()
             completion = completion.replace("ball.x!=", "ball.x !=")
@@ -133,33 +146,87 @@ class Model(abc.ABC, Generic[ObsType, ActType]):
         return None
 
     def ready(self) -> bool:
-        return bool(self.sample_action())
+        # stop at the first successful slice instead of rendering every prompt
+        return any(any(self.successful_slices(t)) for t in self.success_buffer)
+
+    def run(self, *routines: Routine) -> List[Any]:
+        # step routines in lockstep so that concurrent queries reach the LM together
+        results: List[Any] = [None for _ in routines]
+        queries: Dict[int, Query] = {}
+
+        def send(i: int, completion: Optional[str]):
+            try:
+                queries[i] = routines[i].send(completion)
+            except StopIteration as e:
+                results[i] = e.value
+
+        for i in range(len(routines)):
+            send(i, None)
+        while queries:
+            by_stop = defaultdict(list)
+            for i, (prompt, stop) in queries.items():
+                by_stop[stop].append((i, prompt))
+            queries.clear()
+            for stop, batch in by_stop.items():
+                indices, prompts = zip(*batch)
+                completions = self.lm.complete_all(
+                    list(prompts),
+                    stop=[stop],
+                    temperature=self.temperature,
+                    use_cache=self.use_cache,
+                )
+                for i, completion in zip(indices, completions):
+                    send(i, completion)
+        return results
 
     def sample_action(self) -> List[str]:
-        trajectories = list(self.success_buffer)
-        trajectories = [
-            trajectory[start:stop]
-            for trajectory in trajectories
-            for start, stop in itertools.combinations(range(len(trajectory) + 1), 2)
-            if self.successful(trajectory[start:stop])
-        ]
-        self.rng.shuffle(trajectories)
-        return [
-            "".join(
-                [self.policy_env.initial_str()]
-                + [self.policy_env.ts_to_string(ts) for ts in t]
+        # trajectories do not change once buffered, so render and slice each only once
+        # and keep just those pieces, joining the prompts on demand
+        initial_str = self.policy_env.initial_str()
+        rendered_successes = {}
+        prompts = []
+        for trajectory in self.success_buffer:
+            cached, ts_strings, slices = self.rendered_successes.get(
+                id(trajectory), (None, None, None)
             )
-            for t in trajectories
-        ]
-
-    def successful(self, trajectory: List[TimeStep]) -> bool:
-        return not self.sil or self.get_value(trajectory) > self.env.failure_threshold()
-
-    def generate_action(self, state: "ObsType | str", T: int) -> Optional[str]:
+            if cached is not trajectory:
+                ts_strings = [self.policy_env.ts_to_string(ts) for ts in trajectory]
+                slices = list(self.successful_slices(trajectory))
+            rendered_successes[id(trajectory)] = trajectory, ts_strings, slices
+            prompts.extend(
+                "".join([initial_str] + ts_strings[start:stop])
+                for start, stop in slices
+            )
+        self.rendered_successes = rendered_successes
+        self.rng.shuffle(prompts)
+        return prompts
+
+    def successes(self) -> np.ndarray:
+        # buffer_values holds each trajectory's value, computed once when it was added
+        values = np.fromiter(self.buffer_values, dtype=float)
+        return np.logical_or(not self.sil, values > self.env.failure_threshold())
+
+    def successful_slices(
+        self, trajectory: List[TimeStep]
+    ) -> Iterator[Tuple[int, int]]:
+        gamma = self.env.gamma()
+        threshold = self.env.failure_threshold()
+        for start in range(len(trajectory)):
+            # extend the value of trajectory[start:stop] one step at a time,
+            # summing in the same order as rl.common.get_value
+            value = 0
+            for t, ts in enumerate(trajectory[start:]):
+                value += gamma**t * ts.reward
+                if not self.sil or value > threshold:
+                    yield start, start + t + 1
+
+    def generate_action(
+        self, state: "ObsType | str", T: int
+    ) -> Generator[Query, str, Optional[str]]:
         if not isinstance(state, str):
             state = self.env.state_str(state)
         query = state if self.lm is None else ["", self.env.initial_str(), state]
-        maybe_action = self.predict(
+        maybe_action = yield from self.predict(
             ground_truth=None,
             query=query,
             get_prompts=self.sample_action,
@@ -184,11 +251,9 @@ class Q(Model[ObsType, ActType]):
         assert isinstance(self.env.action_space, Discrete)
         actions = range(self.env.action_space.n)
 
-        def get_rollouts():
-            for action in actions:
-                yield self.rollout(state, action, T)
-
-        rollouts, returns = zip(*get_rollouts())
+        rollouts, returns = zip(
+            *self.run(*[self.rollout(state, action, T) for action in actions])
+        )
         action_returns = list(zip(actions, returns))
         self.rng.shuffle(action_returns)
         action, value = max(
@@ -201,7 +266,8 @@ class Q(Model[ObsType, ActType]):
             Colorize.print_header("Q prompts")
             Colorize.print_prediction_type("state:", end=" ")
             Colorize.print_green(state)
-            for a, v in zip(actions, rollouts):
+            for a, completions in zip(actions, rollouts):
+                v = "".join(completions)
                 Colorize.print_prediction_type("action:", end=" ")
                 Colorize.print_green(a)
                 trajectory_strings = [
@@ -228,18 +294,23 @@ class Q(Model[ObsType, ActType]):
         return [self.extend(l, max_len) for l in lists]
 
     def ready(self) -> bool:
-        actions = list(range(self.env.action_space.n))
-        done_ready = [bool(self.sample_done(a)) for a in actions]
-        next_state_ready = any([bool(self.sample_next_state(a)) for a in actions])
-        reward_ready_done = [bool(self.sample_reward(a, True)) for a in actions]
-        reward_ready_not_done = [bool(self.sample_reward(a, False)) for a in actions]
-        reward_ready = [
-            done or not_done
-            for done, not_done in zip(reward_ready_done, reward_ready_not_done)
-        ]
-        return all(done_ready + reward_ready + [next_state_ready]) and super().ready()
+        # the sample_* prompts are non-empty exactly when a matching time step is in
+        # the buffer, so check for those directly instead of building the prompts
+        time_steps = [ts for t in self.buffer for ts in t]
+        if self.constrain_prompts:
+            # sample_done and sample_reward need a time step for every action and
+            # sample_next_state needs a non-terminal time step for some action
+            actions = {ts.action for ts in time_steps}
+            ready = set(range(self.env.action_space.n)) <= actions and any(
+                not ts.done for ts in time_steps
+            )
+        else:
+            ready = bool(time_steps)
+        return ready and super().ready()
 
-    def rollout(self, state: ObsType, action: ActType, T: int) -> Tuple[str, float]:
+    def rollout(
+        self, state: ObsType, action: ActType, T: int
+    ) -> Generator[Query, str, Tuple[List[str], float]]:
         if Debug.debug_rollouts_and_print_inferences.meets_threshold(self.debug):
             Colorize.print_header(
                 f"Computing Q rollout for state {state} and action {action}"
@@ -267,7 +338,7 @@ class Q(Model[ObsType, ActType]):
                 if t == self.max_steps:
                     break
                 true_done_str = self.env.done_str(true_done)
-                done_u = self.predict(
+                done_u = yield from self.predict(
                     ground_truth=None if true_done else true_done_str,
                     query=query,
                     name="done",
@@ -282,7 +353,7 @@ class Q(Model[ObsType, ActType]):
                 done = done_u if self.lm is None else self.env.done(done_u)
                 # noinspection PyUnboundLocalVariable
                 true_reward_str = self.env.reward_str(true_reward)
-                reward_u = self.predict(
+                reward_u = yield from self.predict(
                     ground_truth=None if true_done else true_reward_str,
                     query=query,
                     name="reward",
@@ -300,7 +371,7 @@ class Q(Model[ObsType, ActType]):
                     break
                 # noinspection PyUnboundLocalVariable
                 true_state_str = self.env.state_str(true_state)
-                state_u = self.predict(
+                state_u = yield from self.predict(
                     ground_truth=None if true_done else true_state_str,
                     query=query,
                     name="state",
@@ -318,13 +389,14 @@ class Q(Model[ObsType, ActType]):
                 discounted_return = update_return(true_reward)
             else:
                 raise RuntimeError("Unhandled case")
-            action_u = self.generate_action(state_u, T)
+            action_u = yield from self.generate_action(state_u, T)
             if self.lm is not None:
                 action = self.env.action(action_u)
             completions.append(action_u)
             t += 1
 
-        return "" if self.lm is None else "".join(completions), discounted_return
+        # the completions are only joined if the rollout is printed
+        return ([] if self.lm is None else completions), discounted_return
 
     def sample_done(self, action: int) -> List[str]:
         time_steps = [
@@ -333,7 +405,6 @@ class Q(Model[ObsType, ActType]):
             for ts in t
             if (not self.constrain_prompts) or (ts.action == action)
         ]
-        self.rng.shuffle(time_steps)
         if self.balance_prompts:
             done = [ts for ts in time_steps if ts.done]
             not_done = [ts for ts in time_steps if not ts.done]
@@ -346,8 +417,8 @@ class Q(Model[ObsType, ActType]):
                 # if len(done) > 3:
                 #     breakpoint()
                 balanced = [ts for (d, nd) in zip(done, not_done) for ts in [d, nd]]
-            self.rng.shuffle(balanced)
             time_steps = balanced
+        self.rng.shuffle(time_steps)
         return [
             self.env.state_str(ts.state)
             + self.env.action_str(ts.action)
@@ -367,11 +438,12 @@ class Q(Model[ObsType, ActType]):
             ]
 
         if self.balance_prompts:
-            buffer = [t for t in self.buffer]
-            self.rng.shuffle(buffer)
-            successful = get_time_steps(*[t for t in buffer if self.successful(t)])
+            successes = self.successes()
+            successful = get_time_steps(
+                *[t for t, success in zip(self.buffer, successes) if success]
+            )
             unsuccessful = get_time_steps(
-                *[t for t in buffer if not self.successful(t)]
+                *[t for t, success in zip(self.buffer, successes) if not success]
             )
             if not successful:
                 balanced = unsuccessful
@@ -386,7 +458,7 @@ class Q(Model[ObsType, ActType]):
                 ]
             buffer = balanced
         else:
-            buffer = list(get_time_steps(*self.buffer))
+            buffer = get_time_steps(*self.buffer)
         self.rng.shuffle(buffer)
         return [
             self.env.state_str(ts.state)
@@ -399,9 +471,7 @@ class Q(Model[ObsType, ActType]):
     def sample_reward(self, action: int, done: bool) -> List[str]:
         if self.balance_prompts:
             rewards = defaultdict(list)
-            buffer = [t for t in self.buffer]
-            self.rng.shuffle(buffer)
-            for t in buffer:
+            for t in self.buffer:
                 for ts in t:
                     if (not self.constrain_prompts) or (
                         ts.action == action and ts.done == done
@@ -435,7 +505,7 @@ class Pi(Model[ObsType, ActType]):
     def _act(self, state: ObsType, T: int) -> ActType:
         if Debug.debug_inferences.meets_threshold(self.debug):
             Colorize.print_header(f"Computing pi action for state {state}")
-        action_str = self.generate_action(state, T)
+        [action_str] = self.run(self.generate_action(state, T))
         action = self.env.action(action_str)
         assert action is not None
         return action
@@ -45,6 +45,7 @@ def train(
     total_steps: int,
     use_cache: bool,
     wait_time: Optional[float],
+    buffer_size: Optional[int] = None,
 ):
     local_rank = os.getenv("LOCAL_RANK", None)
     if local_rank is not None:
@@ -52,7 +53,9 @@ def train(
     openai.api_key = os.getenv("OPENAI_API_KEY")
     rng = np.random.default_rng(seed)
 
-    buffer: Deque[List[TimeStep]] = deque()
+    # buffer_size=None keeps every trajectory
+    buffer: Deque[List[TimeStep]] = deque(maxlen=buffer_size)
+    buffer_values: Deque[float] = deque(maxlen=buffer_size)
     success_buffer: Deque[List[TimeStep]] = deque(maxlen=success_buffer_size)
 
     kwargs = dict(
@@ -92,6 +95,7 @@ def train(
     pi = Pi(
         break_on_invalid=break_on_invalid,
         buffer=buffer,
+        buffer_values=buffer_values,
         debug=debug,
         env=env,
         lm=lm,
@@ -109,6 +113,7 @@ def train(
         balance_prompts=balance_prompts,
         break_on_invalid=break_on_invalid,
         buffer=buffer,
+        buffer_values=buffer_values,
         constrain_prompts=constrain_prompts,
         debug=debug,
         env=env,
@@ -196,10 +201,9 @@ def train(
         if timed_out:
             trajectory[-1].done = False
         buffer.append(trajectory)
-        if (
-            not sil
-            or get_value(*trajectory, gamma=env.gamma()) > env.failure_threshold()
-        ):
+        value = get_value(*trajectory, gamma=env.gamma())
+        buffer_values.append(value)
+        if not sil or value > env.failure_threshold():
             success_buffer.append(trajectory)
 
     print("done!")
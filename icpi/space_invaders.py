@@ -1,5 +1,4 @@
 import itertools
-import re
 from dataclasses import dataclass, field
 from typing import Iterable, NamedTuple, Optional, Tuple
 
@@ -71,6 +70,12 @@ class Obs(NamedTuple):
     agent: int
     aliens: Tuple[Alien]
 
+    def alien_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        # coordinates of the live aliens as parallel arrays
+        alive = [(a.x, a.y) for a in self.aliens if not a.is_dead()]
+        xs, ys = np.array(alive, dtype=int).reshape(-1, 2).T
+        return xs, ys
+
     def num_shot_down(self):
         return sum(1 for a in self.aliens if a.is_dead())
 
@@ -95,6 +100,7 @@ class Env(base_env.Env[Obs, int]):
     def action_stop() -> str:
         return "\n"
 
+    @base_env.memoize
     def action_str(self, action: int) -> str:
         if action == 1:
             return f"reward = {self.ship()}.{self.actions()[action]}(aliens){self.action_stop()}"
@@ -157,6 +163,7 @@ class Env(base_env.Env[Obs, int]):
     def state_stop(self) -> str:
         return "\n"
 
+    @base_env.memoize
     def state_str(self, state: Obs) -> str:
         assertions = [
             f"{self.ship()} == {C(state.agent, 0)}",
@@ -254,7 +261,7 @@ class Env(base_env.Env[Obs, int]):
         )
 
     def valid_reward(self, reward_str: str) -> bool:
-        return bool(re.findall(r"reward == \d+", reward_str)) and reward_str.endswith(
+        return bool(base_env.REWARD_PATTERN.search(reward_str)) and reward_str.endswith(
             self.reward_stop()
         )
 
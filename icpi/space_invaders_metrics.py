@@ -3,6 +3,7 @@ from copy import deepcopy
 from dataclasses import dataclass
 from typing import Iterator, List, Optional, Tuple
 
+import numpy as np
 import space_invaders
 from base_env import TimeStep
 from dollar_lambda import command, option
@@ -45,16 +46,12 @@ class Encoder(BaseEncoder):
         return "aliens"
 
     def hint(self, state: Obs) -> str:
+        ship = self.ship()
+        alien = self.alien()
         hint = " and ".join(
-            [
-                (
-                    f"{self.ship()}.x == {self.alien()}[{i}].x"
-                    if a.over(state.agent)
-                    else f"{self.ship()}.x != {self.alien()}[{i}].x"
-                )
-                for i, a in enumerate(state.aliens)
-                if not a.is_dead()
-            ]
+            f"{ship}.x {'==' if a.over(state.agent) else '!='} {alien}[{i}].x"
+            for i, a in enumerate(state.aliens)
+            if not a.is_dead()
         )
         if hint:
             hint = f"and {hint}"
@@ -79,13 +76,10 @@ class Encoder(BaseEncoder):
     def nonterminal_reward_str(self, ts: TimeStep[Obs, int]) -> str:
         reward_str = f"assert reward == {ts.reward}"
         if ts.reward > 0:
-            reward_str += " and ".join(
-                [""]
-                + [
-                    f"alien[{i}] is None"
-                    for i, a in enumerate(ts.next_state.aliens)
-                    if a.is_dead()
-                ]
+            reward_str += "".join(
+                f" and alien[{i}] is None"
+                for i, a in enumerate(ts.next_state.aliens)
+                if a.is_dead()
             )
         return reward_str
 
@@ -100,7 +94,7 @@ class Encoder(BaseEncoder):
         return "ship"
 
     def state_str(self, state: Obs) -> str:
-        aliens = ", ".join([str(a) for a in state.aliens])
+        aliens = ", ".join(map(str, state.aliens))
         return f"assert {self.ship()} == C{(state.agent, 0)} and {self.alien()} == [{aliens}]"
 
     def stop(self) -> List[str]:
@@ -274,7 +268,19 @@ class MoveTransition(Transition):
 
 
 def hopeless(s: Obs) -> bool:
-    return any([a.escaped(s.agent) for a in s.aliens])
+    xs, ys = s.alien_arrays()
+    return bool((np.abs(s.agent - xs) > ys).any())
+
+
+def get_good_actions(s: Obs, width: int) -> List[int]:
+    # the actions whose next state is not hopeless, computed for all actions at once
+    # by applying space_invaders.Env.step analytically
+    xs, ys = s.alien_arrays()
+    moves = np.arange(len(ACTIONS)) - 1
+    agents = np.clip(s.agent + moves, 0, width - 1)
+    shot = (moves == 0)[:, None] & (xs == s.agent)[None, :]
+    escaped = ~shot & (np.abs(agents[:, None] - xs[None, :]) > ys[None, :] - 1)
+    return np.flatnonzero(~escaped.any(axis=1)).tolist()
 
 
 def collect_trajectory(
@@ -286,13 +292,7 @@ def collect_trajectory(
     done = False
     while not done:
         action = env.action_space.sample()
-        good_actions = []
-        if not hopeless(state):
-            for a in range(len(ACTIONS)):
-                _env = deepcopy(env)
-                s, _, _, _ = _env.step(a)
-                if not hopeless(s):
-                    good_actions.append(a)
+        good_actions = [] if hopeless(state) else get_good_actions(state, env.width)
 
         next_state, reward, done, _ = env.step(action)
 
@@ -376,12 +376,15 @@ def main(
             else failure_trajectories
         )
         trajectories.append(get_trajectory(trajectory))
-        for i in range(len(trajectory)):
-            last_time_step: TimeStepWithActions = trajectory[i]
-            sub_trajectory = trajectory[: i + 1]
+        # later prefixes overwrite earlier ones that end in the same state-action,
+        # so only slice the last prefix for each
+        last_indices = {}
+        for i, last_time_step in enumerate(trajectory):
             step = last_time_step.time_step
-            trajectories_by_last_state_action[step.state, step.action] = sub_trajectory
-            envs_by_first_state[trajectory[0].time_step.state] = _env
+            last_indices[step.state, step.action] = i
+        for state_action, i in last_indices.items():
+            trajectories_by_last_state_action[state_action] = trajectory[: i + 1]
+        envs_by_first_state[trajectory[0].time_step.state] = _env
 
     queries = {k: [v] for k, v in trajectories_by_last_state_action.items()}
     # envs = list(envs_by_first_state.values())